@@ -2,123 +2,501 @@ import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.messagebox as mb
 from tkinter import filedialog as fd
+import io
 import re
 import os
 import csv
-from zipfile import ZipFile, ZIP_STORED, ZipInfo
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+from array import array
+from collections import deque
+from zipfile import ZipFile
+import mmap
 import shutil
-import tempfile
+import sqlite3
+import struct
 
 
-class UpdateableZipFile(ZipFile):
+DB_PATH = os.path.join("db", "db.csv")
+SUFFIX = "_FFNORMA"
+
+# Wyszukiwanie numerów norm
+NORM_REGEX = re.compile(r"PN(?: |-).{1,30}?(?:(?::\d{4})(?:-\d\d|))(?:[\S]+?(?:\d{4})|)(?:-\d{2}|)")
+# Notacja sprzed 1994
+NORM94_REGEX = re.compile(r"PN(?: |-)\d{2}/.(?:[\S]+)(?:\d)")
+# Zmiany (+A1, +AC) na końcu numeru, pomijane w kluczu rodziny
+AMENDMENT_REGEX = re.compile(r"(?:\+[A-Z]+\d*)+$")
+# Miesiąc wydania (:2019-06), opcjonalny przy porównywaniu wydań
+MONTH_REGEX = re.compile(r"(:\d{4})-\d{2}$")
+
+
+def load_db(path=DB_PATH):
+    db_main = []
+
+    with open(path, "r", encoding="utf-8", newline="") as readdb:
+        reader = csv.reader(readdb, delimiter=',')
+        for row in reader:
+            db_main.append((row[0], row[1], eval(row[2])))
+
+    return db_main
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Kody statusu w indeksie
+STATUS_MISSING = 0
+STATUS_CURRENT = 1
+STATUS_OUTDATED = 2
+STATUS_INFERRED = 3
+
+
+def family_key(number):
+    """Normalized family of a norm number: prefix, number and part without year or amendment."""
+    key = number.partition(":")[0]
+    if "+" in key:
+        key = AMENDMENT_REGEX.sub("", key)
+    if "  " in key:
+        key = " ".join(key.split())
+    return key.upper()
+
+
+class NormIndex:
+    """
+    Read-only lookup index built from db.csv in a flat, position-independent layout:
+    header, fixed-size records sorted by key (exact numbers, then families),
+    then a blob of utf-8 strings. Records only hold offsets into the blob,
+    so the file can be memory-mapped as is and shared by any number of worker
+    processes through the page cache.
+    """
+
+    MAGIC = b"FFNIDX02"
+    # magic, rozmiar i mtime db.csv, liczba numerów, liczba rodzin
+    HEADER = struct.Struct("<8sQqII")
+    # offset i długość klucza, offset i długość aktualnego numeru, status
+    RECORD = struct.Struct("<IHIHBx")
+
+    def __init__(self, buf):
+        self.buf = buf
+        magic, self.src_size, self.src_mtime, self.count, self.family_count = self.HEADER.unpack_from(buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError("Nieprawidłowy plik indeksu")
+        self.records_off = self.HEADER.size
+        self.families_off = self.records_off + self.count * self.RECORD.size
+        self.strings_off = self.families_off + self.family_count * self.RECORD.size
+        self._tables = None
+
+    @staticmethod
+    def families(db_main):
+        # Rodzina -> aktualne wydanie; numery aktualne mają pierwszeństwo przed
+        # wycofanymi, a rodziny wskazujące na kilka różnych wydań są pomijane
+        current, replaced = {}, {}
+        for d in db_main:
+            current.setdefault(family_key(d[1]), set()).add(d[1])
+            for old in d[2]:
+                replaced.setdefault(family_key(old), set()).add(d[1])
+
+        families = {}
+        for source in (replaced, current):
+            for family, newest in source.items():
+                if len(newest) == 1:
+                    families[family] = next(iter(newest))
+                else:
+                    families.pop(family, None)
+        return families
+
+    @classmethod
+    def build(cls, db_main, src_size=0, src_mtime=0):
+        # Pierwsze dopasowanie w kolejności bazy wygrywa, jak w pętli po db_main
+        table = {}
+        for d in db_main:
+            table.setdefault(d[1], (STATUS_CURRENT, ""))
+            for old in d[2]:
+                table.setdefault(old, (STATUS_OUTDATED, d[1]))
+        families = {k: (STATUS_INFERRED, v) for k, v in cls.families(db_main).items()}
+
+        blob = bytearray()
+        offsets = {}
+
+        def intern(raw):
+            if raw not in offsets:
+                offsets[raw] = len(blob)
+                blob.extend(raw)
+            return offsets[raw], len(raw)
+
+        sections = [sorted((k.encode("utf-8"), v) for k, v in t.items()) for t in (table, families)]
+        out = bytearray(cls.HEADER.pack(cls.MAGIC, src_size, src_mtime, *map(len, sections)))
+        for section in sections:
+            for raw, (status, newest) in section:
+                key_off, key_len = intern(raw)
+                new_off, new_len = intern(newest.encode("utf-8"))
+                out += cls.RECORD.pack(key_off, key_len, new_off, new_len, status)
+        out += blob
+
+        return bytes(out)
+
+    def _record(self, base, i):
+        return self.RECORD.unpack_from(self.buf, base + i * self.RECORD.size)
+
+    def _string(self, off, length):
+        start = self.strings_off + off
+        return self.buf[start:start + length]
+
+    def _search(self, base, count, key):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_off, key_len, _, _, _ = self._record(base, mid)
+            if self._string(key_off, key_len) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < count:
+            key_off, key_len, new_off, new_len, status = self._record(base, lo)
+            if self._string(key_off, key_len) == key:
+                return status, (self._string(new_off, new_len).decode("utf-8") or None)
+
+        return STATUS_MISSING, None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        # Indeks zbudowany w pamięci (bytes) nie wymaga zamykania
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+    def lookup(self, number):
+        """
+        Return (status, current number) for a single norm number. Numbers absent
+        from the database fall back to their family (STATUS_INFERRED).
+        """
+        hit = self._search(self.records_off, self.count, number.encode("utf-8"))
+        if hit[0] == STATUS_MISSING:
+            hit = self._infer(number, self._search(self.families_off, self.family_count,
+                                                   family_key(number).encode("utf-8")))
+        return hit
+
+    @staticmethod
+    def _infer(number, hit):
+        # Nieznana zmiana do aktualnego wydania (np. /Az1) lub numer bez miesiąca
+        # wydania (:2019 zamiast :2019-06) - wydanie jest aktualne
+        if hit[0] == STATUS_INFERRED:
+            edition = number.split("/", 1)[0]
+            if edition == hit[1] or edition == MONTH_REGEX.sub(r"\1", hit[1]):
+                return STATUS_INFERRED, None
+        return hit
+
+    def _decode(self, base, count):
+        table = {}
+        for i in range(count):
+            key_off, key_len, new_off, new_len, status = self._record(base, i)
+            newest = self._string(new_off, new_len).decode("utf-8") or None
+            table[self._string(key_off, key_len).decode("utf-8")] = (status, newest)
+        return table
+
+    def tables(self):
+        """
+        Decode all records into (numbers, families) dicts; built once and cached
+        for bulk lookups. Both dicts are published together in one assignment,
+        so concurrent callers never see a half-built cache.
+        """
+        tables = self._tables
+        if tables is None:
+            tables = (self._decode(self.records_off, self.count),
+                      self._decode(self.families_off, self.family_count))
+            self._tables = tables
+        return tables
+
+    def classify(self, numbers):
+        """
+        Bulk variant of lookup. Returns an array of status codes and a list of
+        current numbers (None where there is none), both in input order.
+        """
+        table, families = self.tables()
+        get = table.get
+        family = families.get
+        missing = (STATUS_MISSING, None)
+        infer = self._infer
+
+        # Każdy numer spoza bazy rozwiązywany przez rodzinę tylko raz
+        resolved = {}
+        cached = resolved.get
+
+        def resolve(n):
+            hit = resolved[n] = infer(n, family(family_key(n), missing))
+            return hit
+
+        hits = [get(n) or cached(n) or resolve(n) for n in numbers]
+
+        return array("B", [h[0] for h in hits]), [h[1] for h in hits]
+
+
+# Indeksy otwarte przez classify(), według ścieżki bazy
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def classify(numbers, db_path=DB_PATH):
+    """
+    Classify many norm numbers at once against the database at db_path.
+    The index is opened once per database and reused until db.csv changes.
+    """
+    st = os.stat(db_path)
+    stat = (st.st_size, st.st_mtime_ns)
+
+    with _indexes_lock:
+        cached = _indexes.get(db_path)
+        if cached is None or cached[0] != stat:
+            # Stary indeks zwalniany przez GC, gdy nikt go już nie używa
+            cached = _indexes[db_path] = (stat, open_index(db_path))
+        index = cached[1]
+
+    return index.classify(numbers)
+
+
+def index_path(db_path):
+    return os.path.splitext(db_path)[0] + ".idx"
+
+
+def default_citations(db_path):
+    # Indeks cytowań na dysku lokalnym obok bazy - blokady SQLite na udziałach SMB są zawodne
+    return os.path.join(os.path.dirname(db_path), "citations.sqlite")
+
+
+def _map_index(path):
+    with open(path, "rb") as f:
+        return NormIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def open_index(db_path=DB_PATH):
     """
-    Add delete (via remove_file) and update (via writestr and write methods)
-    To enable update features use UpdateableZipFile with the 'with statement',
-    Upon  __exit__ (if updates were applied) a new zip file will override the exiting one with the updates
+    Memory-map the index next to db.csv, rebuilding it first when it is missing
+    or older than the database.
     """
+    st = os.stat(db_path)
+    idx_path = index_path(db_path)
 
-    class DeleteMarker(object):
+    try:
+        index = _map_index(idx_path)
+        if (index.src_size, index.src_mtime) == (st.st_size, st.st_mtime_ns):
+            return index
+        index.close()
+    except (OSError, ValueError, struct.error):
         pass
 
-    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
-        # Init base
-        super(UpdateableZipFile, self).__init__(file, mode=mode,
-                                                compression=compression,
-                                                allowZip64=allowZip64)
-        # track file to override in zip
-        self._replace = {}
-        # Whether the with statement was called
-        self._allow_updates = False
-
-    def writestr(self, zinfo_or_arcname, bytes, compress_type=None):
-        if isinstance(zinfo_or_arcname, ZipInfo):
-            name = zinfo_or_arcname.filename
-        else:
-            name = zinfo_or_arcname
-        # If the file exits, and needs to be overridden,
-        # mark the entry, and create a temp-file for it
-        # we allow this only if the with statement is used
-        if self._allow_updates and name in self.namelist():
-            temp_file = self._replace[name] = self._replace.get(name,
-                                                                tempfile.TemporaryFile())
-            temp_file.write(bytes)
-        # Otherwise just act normally
-        else:
-            super(UpdateableZipFile, self).writestr(zinfo_or_arcname,
-                                                    bytes, compress_type=compress_type)
-
-    def write(self, filename, arcname=None, compress_type=None):
-        arcname = arcname or filename
-        # If the file exits, and needs to be overridden,
-        # mark the entry, and create a temp-file for it
-        # we allow this only if the with statement is used
-        if self._allow_updates and arcname in self.namelist():
-            temp_file = self._replace[arcname] = self._replace.get(arcname,
-                                                                   tempfile.TemporaryFile())
-            with open(filename, "rb") as source:
-                shutil.copyfileobj(source, temp_file)
-        # Otherwise just act normally
+    data = NormIndex.build(load_db(db_path), st.st_size, st.st_mtime_ns)
+
+    # Zapis przez plik tymczasowy - inne procesy mogą budować indeks równolegle
+    tmp_path = f"{idx_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, idx_path)
+    except OSError:
+        # Katalog bazy tylko do odczytu lub db.idx zablokowany przez inny
+        # proces (Windows) - indeks zostaje w pamięci procesu
+        return NormIndex(data)
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    return _map_index(idx_path)
+
+
+def read_document_xml(path):
+
+    with open(path, "rb") as f:
+        document = ZipFile(f)
+        xml_content = document.read('word/document.xml')
+
+    return xml_content.decode("utf-8")
+
+
+def find_hits(xml_str):
+    """
+    Find norm numbers in the part; returns current and pre-1994 notation hits
+    as (number, byte offset in the utf-8 encoded part) pairs.
+    """
+    found = []
+
+    for regex in (NORM_REGEX, NORM94_REGEX):
+        hits = []
+        pos = offset = 0
+        for m in regex.finditer(xml_str):
+            offset += len(xml_str[pos:m.start()].encode("utf-8"))
+            pos = m.start()
+            hits.append((m.group(), offset))
+        found.append(hits)
+
+    return found
+
+
+def match_norms(normy, normy94, index):
+
+    # Porównanie wyników wyszukiwania z bazą
+    results = []
+
+    for n in normy:
+        mark = "Brak w bazie"
+        state = "Nieznany" # Up-to-date
+
+        status, newest = index.lookup(n)
+        if status == STATUS_CURRENT:
+            mark = "Znaleziono"
+            state = "Aktualny"
+        elif status == STATUS_OUTDATED:
+            mark = "Znaleziono"
+            state = "Nieaktualny"
+        elif status == STATUS_INFERRED:
+            mark = "Wywnioskowano"
+            state = "Nieaktualny" if newest else "Aktualny"
+
+        results.append((n, mark, state, newest))
+
+    for n94 in normy94:
+        results.append((n94, "Brak w bazie", "Notacja sprzed 1994", None))
+
+    return results
+
+
+def plan_changes(hits, results, part="word/document.xml", inferred=False):
+    """
+    Change-set entries (part, byte offset, old, new) for hits with a newer edition.
+    Editions inferred from the family are guesses: they are left out unless
+    inferred is True, and then marked for review.
+    """
+    changes = []
+
+    for (n, offset), r in zip(hits, results):
+        if r[3] is None:
+            continue
+        change = {"part": part, "offset": offset, "old": n, "new": r[3]}
+        if r[1] == "Wywnioskowano":
+            if not inferred:
+                continue
+            change["inferred"] = True
+        changes.append(change)
+
+    return changes
+
+
+def apply_changes(data, changes):
+    """Patch the utf-8 bytes of a part with (offset, old, new), checking each old text."""
+    out = []
+    pos = 0
+
+    for offset, old, new in sorted(changes):
+        old_b = old.encode("utf-8")
+        if data[offset:offset + len(old_b)] != old_b:
+            raise ValueError(f"Niezgodny tekst na pozycji {offset}: {old}")
+        out.append(data[pos:offset])
+        out.append(new.encode("utf-8"))
+        pos = offset + len(old_b)
+    out.append(data[pos:])
+
+    return b"".join(out)
+
+
+def output_path(path):
+    return path[:-5] + SUFFIX + path[-5:]
+
+
+def patch_docx(path, new_path, changes):
+    """
+    Write a copy of the document with the change-set applied in a single pass:
+    patched parts are rewritten, all other entries are streamed through as is.
+    """
+    parts = {}
+    for change in changes:
+        parts.setdefault(change["part"], []).append((change["offset"], change["old"], change["new"]))
+
+    tmp_path = new_path + ".tmp"
+    try:
+        with ZipFile(path) as zin, ZipFile(tmp_path, "w") as zout:
+            for item in zin.infolist():
+                if item.filename in parts:
+                    zout.writestr(item, apply_changes(zin.read(item), parts[item.filename]))
+                else:
+                    with zin.open(item) as src, zout.open(item, "w") as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp_path, new_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def docx_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                # Pomijamy pliki wynikowe i pliki blokad Worda
+                if not name.endswith(".docx") or name.endswith(SUFFIX + ".docx") or name.startswith("~$"):
+                    continue
+                yield os.path.join(dirpath, name)
+
+
+def changeset_path(path):
+    return path[:-5] + ".ffnorma.json"
+
+
+def write_changeset(path, sha1, changes):
+    # Ścieżka źródła względna do zestawu zmian - katalog można przenieść
+    with open(changeset_path(path), "w", encoding="utf-8") as f:
+        json.dump({"source": os.path.basename(path), "sha1": sha1, "changes": changes},
+                  f, ensure_ascii=False)
+
+
+def apply_changeset(cs_path, inferred=False):
+    """
+    Apply a reviewed change-set to its source document; returns the new path,
+    or None when nothing is left to apply. Inferred entries are skipped unless
+    a reviewer marked them "approved" or inferred is True.
+    """
+    with open(cs_path, "r", encoding="utf-8") as f:
+        changeset = json.load(f)
+
+    changes = [c for c in changeset["changes"]
+               if inferred or not c.get("inferred") or c.get("approved")]
+    if not changes:
+        return None
+
+    path = os.path.join(os.path.dirname(cs_path), changeset["source"])
+    if file_hash(path) != changeset["sha1"]:
+        raise ValueError(f"Plik {path} zmienił się od czasu analizy")
+
+    new_path = output_path(path)
+    patch_docx(path, new_path, changes)
+    return new_path
+
+
+def changesets(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in filenames:
+                    if name.endswith(".ffnorma.json"):
+                        yield os.path.join(dirpath, name)
         else:
-            super(UpdateableZipFile, self).write(filename, 
-                                                 arcname=arcname, compress_type=compress_type)
+            yield path
 
-    def __enter__(self):
-        # Allow updates
-        self._allow_updates = True
-        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        # call base to close zip file, organically
-        try:
-            super(UpdateableZipFile, self).__exit__(exc_type, exc_val, exc_tb)
-            if len(self._replace) > 0:
-                self._rebuild_zip()
-        finally:
-            # In case rebuild zip failed,
-            # be sure to still release all the temp files
-            self._close_all_temp_files()
-            self._allow_updates = False
-
-    def _close_all_temp_files(self):
-        for temp_file in self._replace.values():
-            if hasattr(temp_file, 'close'):
-                temp_file.close()
-
-    def remove_file(self, path):
-        self._replace[path] = self.DeleteMarker()
-
-    def _rebuild_zip(self):
-        tempdir = tempfile.mkdtemp()
-        try:
-            temp_zip_path = os.path.join(tempdir, 'new.zip')
-            with ZipFile(self.filename, 'r') as zip_read:
-                # Create new zip with assigned properties
-                with ZipFile(temp_zip_path, 'w', compression=self.compression,
-                             allowZip64=self._allowZip64) as zip_write:
-                    for item in zip_read.infolist():
-                        # Check if the file should be replaced / or deleted
-                        replacement = self._replace.get(item.filename, None)
-                        # If marked for deletion, do not copy file to new zipfile
-                        if isinstance(replacement, self.DeleteMarker):
-                            del self._replace[item.filename]
-                            continue
-                        # If marked for replacement, copy temp_file, instead of old file
-                        elif replacement is not None:
-                            del self._replace[item.filename]
-                            # Write replacement to archive,
-                            # and then close it (deleting the temp file)
-                            replacement.seek(0)
-                            data = replacement.read()
-                            replacement.close()
-                        else:
-                            data = zip_read.read(item.filename)
-                        zip_write.writestr(item, data)
-            # Override the archive with the updated one
-            shutil.move(temp_zip_path, self.filename)
-        finally:
-            shutil.rmtree(tempdir)
-            
-            
 class App(tk.Tk):
     
     def __init__(self, data):
@@ -126,7 +504,7 @@ class App(tk.Tk):
         self.minsize(360, 200)
         self.maxsize(360, 200)
 
-        self.db_main = data
+        self.index = data
         
         self.title("ffnorma")
         self.heading = tk.Label(text="ffnorma", padx=15, pady=15, font=("Arial Black", 24))
@@ -158,7 +536,7 @@ class App(tk.Tk):
 
     def open_window(self):
 
-        raport_window = Raport(self, self.filepath, self.db_main)
+        raport_window = Raport(self, self.filepath, self.index)
         raport_window.grab_set()
 
         
@@ -171,7 +549,7 @@ class Raport(tk.Toplevel):
         self.result_headers = ["Wykryta nazwa", "Status bazy", "Status aktualności", "Aktualna nazwa"]
         self.filepath = path
 
-        self.db_main = data
+        self.index = data
         self.xml_str = ""
         self.result_list = self.file_analysis()        
         
@@ -217,94 +595,549 @@ class Raport(tk.Toplevel):
         
     def xml_to_str(self):
 
-        with open(self.filepath.get(), "rb") as f:
-            document = ZipFile(f)
-            xml_content = document.read('word/document.xml')
-
-        # xml_str = xml.etree.ElementTree.tostring(tree, encoding="unicode", method="html")
-        self.xml_str = xml_content.decode("utf-8")
+        self.xml_str = read_document_xml(self.filepath.get())
 
-        
        
     def file_analysis(self):
 
         self.xml_to_str()
-        
-        # Wyszukiwanie wyników
-        regex = r"PN(?: |-).{1,30}?(?:(?::\d{4})(?:-\d\d|))(?:[\S]+?(?:\d{4})|)(?:-\d{2}|)"
-        normy = re.findall(regex, self.xml_str)
+        hits, hits94 = find_hits(self.xml_str)
+        self.hits = hits + hits94
+
+        return match_norms([n for n, _ in hits], [n for n, _ in hits94], self.index)
+
+
+    def final_docx(self):
 
-        # Wyszukiwanie notacji przed 1994
-        regex94 = r"PN(?: |-)\d{2}/.(?:[\S]+)(?:\d)"
-        normy94 = re.findall(regex94, self.xml_str)
+        changes = plan_changes(self.hits, self.result_list)
+        if not changes:
+            mb.showinfo("Info", "Brak norm do podmiany")
+            return
 
-        # Porównanie wyników wyszukiwania z bazą
-        results = []
-        found = 0
+        self.new_path = tk.StringVar()
+        self.new_path.set(output_path(self.filepath.get()))
 
-        for n in normy:
-            mark = "Brak w bazie"
-            state = "Nieznany" # Up-to-date
-            newest = None
+        patch_docx(self.filepath.get(), self.new_path.get(), changes)
 
-            for d in self.db_main:
-                if n == d[1]:
-                    mark = "Znaleziono"
-                    state = "Aktualny"
-                    found += 1
-                    break
+        mb.showinfo("Info", f"Utworzono plik {self.new_path.get()}")
 
-                elif n in d[2]:
-                    mark = "Znaleziono"
-                    state = "Nieaktualny"
-                    newest = d[1]
-                    found += 1
-                    break
 
-            results.append((n, mark, state, newest))
+class Manifest:
+    """
+    Persistent record of processed documents: path -> size, mtime, content hash
+    and the norm numbers found in the document. Saved as JSON next to the
+    watched tree, so a restart only has to stat files instead of rescanning them.
+    """
 
-        for n94 in normy94:
-            results.append((n94, "Brak w bazie", "Notacja sprzed 1994", None))
+    def __init__(self, path):
+        self.path = path
+        self.db_hash = None
+        self.documents = {}
 
-        return results
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.db_hash = data.get("db_hash")
+            self.documents = data.get("documents", {})
 
+    def save(self):
+        # Zapis przez plik tymczasowy, aby przerwanie nie uszkodziło manifestu
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"db_hash": self.db_hash, "documents": self.documents},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
 
-    def final_docx(self):
 
-        self.new_path_s = self.filepath.get()
-        self.new_path_s = self.new_path_s[:-5]+"_FFNORMA"+self.new_path_s[-5:]
-        self.new_path = tk.StringVar()
-        self.new_path.set(self.new_path_s)    
+class CitationIndex:
+    """
+    Persistent reverse index: norm number -> documents, parts and byte offsets
+    where it is cited. Kept in SQLite and updated as documents are processed,
+    so queries do not need to rescan the archive.
+    """
 
-        # Podmiana stringow w xml_str        
-        for positive_match in self.result_list:
-            if positive_match[3] != None:
-                self.xml_str = self.xml_str.replace(positive_match[0], positive_match[3], 1)
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                sha1 TEXT
+            );
+            CREATE TABLE IF NOT EXISTS citations (
+                norm TEXT NOT NULL,
+                document INTEGER NOT NULL REFERENCES documents(id),
+                part TEXT NOT NULL,
+                offset INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS citations_norm ON citations(norm);
+            CREATE INDEX IF NOT EXISTS citations_document ON citations(document);
+        """)
 
-        self.new_output = bytes(self.xml_str, 'utf-8')
-        with open("document.xml", "wb") as f:
-            f.write(self.new_output)
-            
-        kopia = shutil.copy(self.filepath.get(), self.new_path.get())
-        # with open('output_test.txt', 'w', encoding="utf-8") as f:
-        #     f.write(xml_str)
-        
-        with UpdateableZipFile(self.new_path.get(), "a") as o:
-            o.write(r"document.xml", "word/document.xml")
+    def update(self, path, sha1, hits, part="word/document.xml"):
+        """Replace all citations of a document with (number, offset) hits."""
+        self.remove(path)
+        cur = self.conn.execute("INSERT INTO documents (path, sha1) VALUES (?, ?)", (path, sha1))
+        self.conn.executemany("INSERT INTO citations VALUES (?, ?, ?, ?)",
+                              [(n, cur.lastrowid, part, offset) for n, offset in hits])
 
-        mb.showinfo("Info", f"Utworzono plik {self.new_path.get()}")
+    def remove(self, path):
+        self.conn.execute("DELETE FROM citations WHERE document IN "
+                          "(SELECT id FROM documents WHERE path = ?)", (path,))
+        self.conn.execute("DELETE FROM documents WHERE path = ?", (path,))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def citing(self, number):
+        """Return (path, part, offset) for every place the norm number appears."""
+        return self.conn.execute(
+            "SELECT d.path, c.part, c.offset FROM citations c JOIN documents d ON d.id = c.document "
+            "WHERE c.norm = ? ORDER BY d.path, c.part, c.offset", (number,)).fetchall()
+
+    def documents(self, numbers):
+        """Return paths of documents citing any of the norm numbers."""
+        paths = set()
+        numbers = list(numbers)
+        # Limit parametrów SQLite - zapytania w paczkach
+        for i in range(0, len(numbers), 500):
+            chunk = numbers[i:i + 500]
+            paths.update(row[0] for row in self.conn.execute(
+                "SELECT DISTINCT d.path FROM citations c JOIN documents d ON d.id = c.document "
+                f"WHERE c.norm IN ({','.join('?' * len(chunk))})", chunk))
+        return sorted(paths)
+
+    def paths(self):
+        return {row[0] for row in self.conn.execute("SELECT path FROM documents")}
+
+    def norms(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT norm FROM citations")]
+
+    def affected(self, old_index, new_index):
+        """Return documents whose cited norms resolve differently in the new database."""
+        norms = self.norms()
+        old_status, old_newest = old_index.classify(norms)
+        new_status, new_newest = new_index.classify(norms)
+        changed = [n for n, a, b, c, d in zip(norms, old_status, new_status, old_newest, new_newest)
+                   if (a, c) != (b, d)]
+        return self.documents(changed)
+
+
+class Watcher:
+    """
+    Polls a directory tree and rewrites only documents that are new, changed
+    since the last pass or affected by an update of the norm database.
+    """
+
+    def __init__(self, root, db_path=DB_PATH, manifest_path=None, citations_path=None, workers=4,
+                 dry_run=False):
+        self.root = root
+        self.db_path = db_path
+        self.dry_run = dry_run
+        self.workers = max(1, workers)
+        self.manifest = Manifest(manifest_path or os.path.join(root, ".ffnorma_manifest.json"))
+        citations_path = citations_path or default_citations(db_path)
+        try:
+            self.citations = CitationIndex(citations_path)
+        except sqlite3.Error as e:
+            # Katalog bazy tylko do odczytu - obserwacja działa bez indeksu cytowań
+            print(f"Indeks cytowań {citations_path} niedostępny: {e}")
+            self.citations = None
+
+        # Dokumenty nieobecne w indeksie cytowań trzeba przetworzyć ponownie
+        if self.citations is not None:
+            indexed = self.citations.paths()
+            for path in list(self.manifest.documents):
+                if path not in indexed:
+                    del self.manifest.documents[path]
+        self.index = None
+        self.db_stat = None
+        self.lock = threading.Lock()
+
+    def reload_db(self):
+        """Reload the database if it changed; returns True when it did."""
+        st = os.stat(self.db_path)
+        stat = (st.st_size, st.st_mtime_ns)
+        if self.index is not None and stat == self.db_stat:
+            return False
+
+        db_hash = file_hash(self.db_path)
+        # Stare mapowanie zamykane przed przebudową - na Windows blokuje os.replace pliku db.idx.
+        # Przeładowanie odbywa się między przebiegami, gdy żaden wątek nie używa indeksu.
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        self.index = open_index(self.db_path)
+        self.db_stat = stat
+        changed = self.manifest.db_hash is not None and db_hash != self.manifest.db_hash
+        self.manifest.db_hash = db_hash
+        return changed
+
+    def changed_documents(self):
+        pending = []
+        seen = set()
+
+        for path in docx_files([self.root]):
+            seen.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            entry = self.manifest.documents.get(path)
+            if entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+                continue
+
+            # Zmieniony czas modyfikacji przy tym samym rozmiarze nie musi oznaczać
+            # zmiany treści; nowe pliki hashuje dopiero process() w puli wątków
+            if entry is not None and entry["size"] == st.st_size:
+                try:
+                    digest = file_hash(path)
+                except OSError:
+                    continue
+                if entry["sha1"] == digest:
+                    entry["mtime"] = st.st_mtime_ns
+                    continue
+
+            pending.append(path)
+
+        for path in list(self.manifest.documents):
+            if path not in seen:
+                del self.manifest.documents[path]
+                if self.citations is not None:
+                    self.citations.remove(path)
+
+        return pending
+
+    def affected_documents(self):
+        # Ponowne dopasowanie zapisanych numerów do nowej bazy, bez czytania plików
+        affected = []
+        for path, entry in self.manifest.documents.items():
+            results = match_norms(entry["normy"], entry["normy94"], self.index)
+            if [list(r) for r in results] != entry["results"]:
+                affected.append(path)
+        return affected
+
+    def process(self, path):
+        st = os.stat(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        xml_str = ZipFile(io.BytesIO(data)).read('word/document.xml').decode("utf-8")
+        hits, hits94 = find_hits(xml_str)
+        normy, normy94 = [n for n, _ in hits], [n for n, _ in hits94]
+        results = match_norms(normy, normy94, self.index)
+        changes = plan_changes(hits, results, inferred=self.dry_run)
+
+        # Wynik tylko dla dokumentów wymagających zmian; nieaktualny wynik jest usuwany
+        target = changeset_path(path) if self.dry_run else output_path(path)
+        if not changes:
+            if os.path.exists(target):
+                os.remove(target)
+        elif self.dry_run:
+            write_changeset(path, digest, changes)
+        else:
+            patch_docx(io.BytesIO(data), target, changes)
+
+        with self.lock:
+            if self.citations is not None:
+                self.citations.update(path, digest, hits + hits94)
+            self.manifest.documents[path] = {
+                "size": st.st_size,
+                "mtime": st.st_mtime_ns,
+                "sha1": digest,
+                "normy": normy,
+                "normy94": normy94,
+                "results": [list(r) for r in results],
+            }
+
+    def worker(self, jobs):
+        while True:
+            path = jobs.get()
+            try:
+                if path is None:
+                    return
+                self.process(path)
+                print(f"Przetworzono {path}")
+            except Exception as e:
+                # Bez wpisu w manifeście dokument wróci w następnym przebiegu
+                with self.lock:
+                    self.manifest.documents.pop(path, None)
+                print(f"Błąd przetwarzania {path}: {e}")
+            finally:
+                jobs.task_done()
+
+    def run_pass(self):
+        db_changed = self.reload_db()
+        pending = self.changed_documents()
+        if db_changed:
+            pending = list(dict.fromkeys(pending + self.affected_documents()))
+
+        # Ograniczona kolejka - skanowanie nie wyprzedza przetwarzania
+        jobs = queue.Queue(maxsize=self.workers * 2)
+        threads = [threading.Thread(target=self.worker, args=(jobs,), daemon=True)
+                   for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+        for path in pending:
+            jobs.put(path)
+        for _ in threads:
+            jobs.put(None)
+        for t in threads:
+            t.join()
+
+        self.manifest.save()
+        if self.citations is not None:
+            self.citations.commit()
+        return pending
+
+    def run(self, interval=30.0, once=False):
+        while True:
+            self.run_pass()
+            if once:
+                return
+            time.sleep(interval)
+
+
+class ByteQueue:
+    """
+    Bounded queue limited by the total size of queued items instead of their
+    count, so memory use stays capped no matter how large the documents are.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = deque()
+        self.cond = threading.Condition()
+
+    def put(self, item, size=0):
+        with self.cond:
+            # Element większy niż limit przechodzi, gdy kolejka jest pusta
+            while self.size and self.size + size > self.max_bytes:
+                self.cond.wait()
+            self.items.append((item, size))
+            self.size += size
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            item, size = self.items.popleft()
+            self.size -= size
+            self.cond.notify_all()
+            return item
+
+
+class StageStats:
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, size, seconds):
+        with self.lock:
+            self.items += 1
+            self.bytes += size
+            self.busy += seconds
+
+    def report(self, elapsed):
+        # Przepustowość etapu liczona względem czasu pracy jego wątków
+        mb = self.bytes / (1 << 20)
+        return (f"{self.name}: {self.items} plików, {mb:.1f} MB w {elapsed:.1f} s, "
+                f"przepustowość {mb / self.busy if self.busy else 0:.1f} MB/s, "
+                f"zajętość wątków {self.busy:.1f} s")
+
+
+class Pipeline:
+    """
+    Batch processing in three stages connected by byte-bounded queues:
+    readers prefetch whole docx files (hiding latency of network shares),
+    workers scan them and writers save results in the background.
+    Found citations are recorded in the optional CitationIndex on the way.
+    """
+
+    def __init__(self, index, readers=4, workers=2, writers=2, queue_bytes=64 << 20, dry_run=False,
+                 citations=None):
+        self.index = index
+        self.citations = citations
+        self.lock = threading.Lock()
+        self.readers = max(1, readers)
+        self.workers = max(1, workers)
+        self.writers = max(1, writers)
+        self.queue_bytes = queue_bytes
+        self.dry_run = dry_run
+        self.stats = [StageStats("Odczyt"), StageStats("Analiza"), StageStats("Zapis")]
+        self.errors = []
+        self.written = []
+
+    def _stage(self, source, target, stats, func):
+        while True:
+            item = source.get()
+            if item is None:
+                return
+            start = time.perf_counter()
+            try:
+                result, size = func(item)
+            except Exception as e:
+                self.errors.append((item[0], e))
+                continue
+            stats.add(size, time.perf_counter() - start)
+            if target is not None and result is not None:
+                target.put(result, size)
+
+    def read(self, item):
+        path, = item
+        with open(path, "rb") as f:
+            data = f.read()
+        return (path, data), len(data)
+
+    def analyze(self, item):
+        path, data = item
+        xml_str = ZipFile(io.BytesIO(data)).read('word/document.xml').decode("utf-8")
+        hits, hits94 = find_hits(xml_str)
+        if self.citations is not None:
+            digest = hashlib.sha1(data).hexdigest()
+            with self.lock:
+                self.citations.update(path, digest, hits + hits94)
+        results = match_norms([n for n, _ in hits], [n for n, _ in hits94], self.index)
+        changes = plan_changes(hits, results, inferred=self.dry_run)
+        # Dokumenty bez zmian nie trafiają do zapisu
+        if not changes:
+            return None, len(data)
+        return (path, data, changes), len(data)
+
+    def write(self, item):
+        path, data, changes = item
+        if self.dry_run:
+            write_changeset(path, hashlib.sha1(data).hexdigest(), changes)
+            new_path = changeset_path(path)
+        else:
+            new_path = output_path(path)
+            patch_docx(io.BytesIO(data), new_path, changes)
+        self.written.append(new_path)
+        return None, len(data)
+
+    def run(self, paths):
+        paths_q = queue.Queue(maxsize=self.readers * 4)
+        read_q = ByteQueue(self.queue_bytes)
+        write_q = ByteQueue(self.queue_bytes)
+
+        stages = [
+            (paths_q, read_q, self.stats[0], self.read, self.readers),
+            (read_q, write_q, self.stats[1], self.analyze, self.workers),
+            (write_q, None, self.stats[2], self.write, self.writers),
+        ]
+        start = time.perf_counter()
+        running = []
+        for source, target, stats, func, count in stages:
+            threads = [threading.Thread(target=self._stage, args=(source, target, stats, func), daemon=True)
+                       for _ in range(count)]
+            for t in threads:
+                t.start()
+            running.append((source, threads))
+
+        # Wyszukiwanie plików równolegle z odczytem - wątki etapów już działają
+        for path in paths:
+            paths_q.put((path,))
+
+        # Zamykanie etapów po kolei - każdy kończy się po opróżnieniu poprzedniego
+        for source, threads in running:
+            for _ in threads:
+                source.put(None)
+            for t in threads:
+                t.join()
+
+        if self.citations is not None:
+            self.citations.commit()
+        return time.perf_counter() - start
 
 
 if __name__ == "__main__":
 
-    # Wczytanie bazy na samym początku programu
-    db_main = []
+    parser = argparse.ArgumentParser(prog="ffnorma",
+                                     description="Wyszukuje i aktualizuje numery norm w dokumentach docx")
+    parser.add_argument("--watch", metavar="KATALOG",
+                        help="obserwuj katalog i aktualizuj nowe lub zmienione dokumenty")
+    parser.add_argument("--manifest", metavar="PLIK",
+                        help="plik manifestu (domyślnie KATALOG/.ffnorma_manifest.json)")
+    parser.add_argument("--citations", metavar="PLIK",
+                        help="indeks cytowań (domyślnie citations.sqlite obok bazy norm; "
+                             "w trybie wsadowym zapisywany tylko po podaniu tej opcji)")
+    parser.add_argument("--cites", metavar="NUMER",
+                        help="wypisz dokumenty cytujące normę")
+    parser.add_argument("--affected", metavar="STARA_BAZA",
+                        help="wypisz dokumenty, których dotyczy zmiana bazy względem STARA_BAZA")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="zamiast podmiany zapisz zestawy zmian *.ffnorma.json do przeglądu")
+    parser.add_argument("--apply", metavar="ZESTAW", nargs="+",
+                        help="zastosuj zatwierdzone zestawy zmian (pliki lub katalogi)")
+    parser.add_argument("--batch", metavar="ŚCIEŻKA", nargs="+",
+                        help="przetwórz wsadowo pliki lub katalogi potokiem odczyt/analiza/zapis")
+    parser.add_argument("--readers", type=int, default=4,
+                        help="liczba wątków odczytu w trybie wsadowym")
+    parser.add_argument("--queue-mb", type=int, default=64,
+                        help="limit rozmiaru kolejek między etapami w MB")
+    parser.add_argument("--apply-inferred", action="store_true",
+                        help="stosuj także wywnioskowane zmiany bez oznaczenia \"approved\"")
+    parser.add_argument("--interval", type=float, default=30.0,
+                        help="odstęp między przebiegami w sekundach")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="liczba wątków przetwarzających dokumenty")
+    parser.add_argument("--once", action="store_true",
+                        help="wykonaj jeden przebieg i zakończ")
+    parser.add_argument("--db", default=DB_PATH, help="ścieżka do bazy norm")
+    args = parser.parse_args()
+    citations_path = args.citations or default_citations(args.db)
 
-    with open(r"db\db.csv", "r", encoding="utf-8", newline="") as readdb:
-        reader = csv.reader(readdb, delimiter=',')
-        for row in reader:
-            db_main.append((row[0], row[1], eval(row[2])))
+    if args.cites:
+        citations = CitationIndex(citations_path)
+        for path, part, offset in citations.citing(args.cites):
+            print(f"{path}\t{part}\t{offset}")
+    elif args.affected:
+        citations = CitationIndex(citations_path)
+        for path in citations.affected(open_index(args.affected), open_index(args.db)):
+            print(path)
+    elif args.apply:
+        for cs_path in changesets(args.apply):
+            try:
+                new_path = apply_changeset(cs_path, inferred=args.apply_inferred)
+                if new_path is None:
+                    print(f"Pominięto {cs_path}: brak zatwierdzonych zmian")
+                else:
+                    print(f"Utworzono plik {new_path}")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Błąd zestawu zmian {cs_path}: {e}")
+    elif args.batch:
+        # Indeks cytowań w trybie wsadowym tylko na życzenie
+        citations = CitationIndex(args.citations) if args.citations else None
+        pipeline = Pipeline(open_index(args.db), readers=args.readers, workers=args.workers,
+                            queue_bytes=args.queue_mb << 20, dry_run=args.dry_run,
+                            citations=citations)
+        elapsed = pipeline.run(docx_files(args.batch))
+        for path in pipeline.written:
+            print(f"Utworzono plik {path}")
+        for path, e in pipeline.errors:
+            print(f"Błąd przetwarzania {path}: {e}")
+        for stats in pipeline.stats:
+            print(stats.report(elapsed))
+    elif args.watch:
+        watcher = Watcher(args.watch, db_path=args.db, manifest_path=args.manifest,
+                          citations_path=citations_path, workers=args.workers,
+                          dry_run=args.dry_run)
+        watcher.run(interval=args.interval, once=args.once)
+    else:
+        # Wczytanie bazy na samym początku programu
+        index = open_index(args.db)
 
-    app = App(db_main)
-    app.iconbitmap(r'ico\yellow-icon.ico')
-    app.mainloop()
\ No newline at end of file
+        app = App(index)
+        app.iconbitmap(os.path.join("ico", "yellow-icon.ico"))
+        app.mainloop()